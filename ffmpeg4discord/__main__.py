@@ -1,7 +1,4 @@
 import sys
-from glob import glob
-import webbrowser
-from flask import Flask, render_template, url_for, request
 import time
 import threading
 from pathlib import Path
@@ -13,9 +10,6 @@ from ffmpeg4discord.twopass import TwoPass, seconds_to_timestamp
 
 def twopass_loop(twopass: TwoPass, target_filesize: float, approx: bool = False) -> None:
     while True:
-        # clean up before each run
-        cleanup_files("ffmpeg2pass*")
-
         # run the two-pass encoding
         current_filesize = twopass.run()
 
@@ -31,23 +25,17 @@ def twopass_loop(twopass: TwoPass, target_filesize: float, approx: bool = False)
         # adjust the class's target file size to set a lower bitrate for the next run
         twopass.target_filesize -= 0.2
 
-    # final cleanup
-    cleanup_files("ffmpeg2pass*")
-
     # set the final message
     twopass.message = f"Your compressed video file ({round(twopass.output_filesize, 2)}MB) is located at {Path(twopass.output_filename).resolve()}"
 
 
 def open_browser(port: int) -> None:
+    import webbrowser
+
     time.sleep(0.5)
     webbrowser.open(f"http://localhost:{port}")
 
 
-def cleanup_files(pattern: str) -> None:
-    for file in glob(pattern):
-        Path(file).unlink()
-
-
 def main() -> None:
     # get args from the command line
     args = arguments.get_args()
@@ -64,6 +52,9 @@ def main() -> None:
     twopass = TwoPass(**args)
 
     if web:
+        # Flask is only needed for the Web UI, so command line runs and --help don't pay for importing it
+        from flask import Flask, render_template, url_for, request
+
         app = Flask(__name__, static_folder=path.parent)
 
         @app.route("/")
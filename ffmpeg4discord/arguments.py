@@ -1,18 +1,37 @@
 import json
 import logging
-import socket
 
 from argparse import ArgumentParser, Namespace, BooleanOptionalAction
 from pathlib import Path
 from random import randint
+from typing import Optional
 
 
 def is_port_in_use(port: int) -> bool:
+    # only the Web UI needs a port
+    import socket
+
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        return s.connect_ex(("localhost", port)) == 0
+        # the loopback address skips a "localhost" name lookup, and the timeout keeps a filtered port from stalling
+        s.settimeout(0.05)
+        return s.connect_ex(("127.0.0.1", port)) == 0
+
+
+def load_config(src) -> dict:
+    """
+    Read a JSON configuration file
+    :param src: the path to the file, or an already open file-like object
+    :return: the configuration
+    """
+
+    if hasattr(src, "read"):
+        return json.load(src)
 
+    with open(Path(src).resolve()) as f:
+        return json.load(f)
 
-def get_args() -> Namespace:
+
+def get_args(argv: Optional[list] = None) -> Namespace:
     parser = ArgumentParser(
         prog="ffmpeg4discord",
         description="This script takes a video file and compresses it to a target file size.",
@@ -46,13 +65,33 @@ def get_args() -> Namespace:
     )
     parser.add_argument("-a", "--audio-br", type=float, default=96, help="Audio bitrate in kbps.")
     parser.add_argument(
-        "-c", "--codec", type=str, default="libx264", choices=["libx264", "libvpx-vp9"], help="Video codec."
+        "--max-bitrate",
+        type=float,
+        help="Upper limit for the video bitrate in kbps. Useful for short clips with a large target file size.",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        help="Stop an ffmpeg run that takes longer than this many seconds.",
+    )
+    parser.add_argument(
+        "--always-two-pass",
+        action=BooleanOptionalAction,
+        help="Encode clips of 15 seconds or less with two passes too, instead of a single CRF pass.",
+    )
+    parser.add_argument(
+        "-c",
+        "--codec",
+        type=str,
+        default="libx264",
+        choices=["libx264", "libvpx-vp9", "h264_nvenc"],
+        help="Video codec.",
     )
     parser.add_argument(
         "--vp9-opts",
         type=str,
         default=None,
-        help="""JSON string to configure row-mt, deadline, and cpu-used options for VP9 encoding. (e.g., --vp9-opts \'{"row-mt": 1, "deadline": "good", "cpu-used": 2}\')')""",
+        help="""JSON string to configure row-mt, deadline, cpu-used, tile-columns, and threads options for VP9 encoding. (e.g., --vp9-opts \'{"row-mt": 1, "deadline": "good", "cpu-used": 2}\')')""",
     )
 
     # video filters
@@ -67,13 +106,12 @@ def get_args() -> Namespace:
     parser.add_argument("--web", action=BooleanOptionalAction, help="Launch ffmpeg4discord's Web UI in your browser.")
     parser.add_argument("-p", "--port", type=int, help="Local port for the Flask application.")
 
-    args = vars(parser.parse_args())
+    # argv defaults to sys.argv[1:], other callers (e.g. tests) can pass their own arguments
+    args = vars(parser.parse_args(argv))
 
     # fill in from the config JSON
     if args["config"]:
-        file_path = Path(args["config"]).resolve()
-        with open(file_path) as f:
-            config: dict = json.load(f)
+        config = load_config(args["config"])
 
         for k, v in config.items():
             if not args[k]:
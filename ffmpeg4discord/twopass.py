@@ -1,15 +1,93 @@
+import atexit
+import functools
+import hashlib
 import json
 import logging
 import math
 import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
 
-from datetime import datetime
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
 from pathlib import Path
+from textwrap import dedent
+from types import MappingProxyType
 from typing import Optional
 
 import ffmpeg
 
-logging.getLogger().setLevel(logging.INFO)
+# HH:MM:SS timestamps, and HHMMSS or HHMMSS-HHMMSS file name prefixes
+_TS_RE = re.compile(r"(\d{2}):(\d{2}):(\d{2})")
+_FNAME_TIMES_RE = re.compile(r"(\d{2})(\d{2})(\d{2})(?:.(\d{2})(\d{2})(\d{2}))?")
+
+# the ffmpeg and ffprobe executables, looked up on the PATH once instead of on every run
+_FFMPEG = shutil.which("ffmpeg") or "ffmpeg"
+_FFPROBE = shutil.which("ffprobe") or "ffprobe"
+
+# one lock per pass 1 stats file, see TwoPass._run_two_pass(), and how many TwoPass instances use each file.
+# both are only changed while holding _STATS_LOCK, see _use_stats() and _release_stats()
+_STATS_LOCK = threading.Lock()
+_STATS_LOCKS = {}
+_STATS_USERS = Counter()
+
+# ffprobe results for files that were already probed, set by _probe_cache_dir() on first use
+PROBE_CACHE_DIR: Optional[Path] = None
+# how many ffprobe results are kept on disk, the least recently used are deleted first
+_PROBE_CACHE_ENTRIES = 500
+
+# ffprobe options: only the format and stream fields TwoPass reads. The tags, disposition and side data sections
+# are still printed, since ffmpeg.probe() also passes -show_format and -show_streams
+_PROBE_ARGS = {
+    "show_entries": "format=duration,bit_rate:stream=index,codec_type,codec_name,width,height,r_frame_rate,bit_rate,duration",
+}
+
+# a small probe window for containers that keep the duration and bitrates in their headers. Others (e.g. MPEG-TS
+# or raw streams) are probed with ffprobe's defaults, which it needs to estimate them and to find every stream
+_PROBE_LIMITS = {"probesize": "1M", "analyzeduration": "1000000"}
+_HEADER_METADATA_SUFFIXES = (".mp4", ".m4v", ".mov")
+
+# hardware video encoders, which handle their rate control in a single ffmpeg run
+HW_CODECS = ("h264_nvenc",)
+
+# the source video codec that each encoder's output container can take as a stream copy
+_COPY_CODECS = {"libx264": "h264", "h264_nvenc": "h264", "libvpx-vp9": "vp9"}
+
+# CRF values for single pass encodes of sources that already fit the target bitrate
+_CRF = {"libx264": 18, "libvpx-vp9": 24}
+
+# clips up to this many seconds skip pass 1, it costs about as much as the encode itself for little gain
+_SHORT_CLIP_SECONDS = 15
+# short clips get a CRF from their bitrate, see _crf_for_bitrate(): the codec's usual CRF at
+# _CRF_BASELINE_BPP bits per output pixel, and the lowest and highest CRF to pick
+_SHORT_CLIP_CRF = {"libx264": (23, 18, 32), "libvpx-vp9": (31, 24, 42)}
+_CRF_BASELINE_BPP = 0.08
+# free space /dev/shm needs before pass 1 stats go there, .mbtree files of long clips get large
+_SHM_MIN_FREE = 1 << 30
+
+# multi-line messages, dedented once at import time
+_TIME_PARADOX_MSG = dedent(
+    """
+    Time Paradox?
+
+    Something is wrong with your clipping times. Use this
+    information to further diagnose the problem:
+
+    - Your video is {duration} minutes long
+    - Your clipping times are {times}
+    """
+)
+_ASPECT_RATIO_MSG = dedent(
+    """
+    Your output resolution's aspect ratio does not match the
+    input resolution's or your croped resolution's aspect ratio.
+    """
+)
 
 
 class TwoPass:
@@ -28,11 +106,17 @@ class TwoPass:
         output (str): Output file path or directory where the compressed video will be saved.
         times (dict): Dictionary with keys "from" and "to" specifying timestamps (in seconds) for encoding a segment.
         audio_br (float): Audio bitrate in kilobits per second (kbps), if specified. Defaults to automatic calculation.
-        codec (str): Video codec to use for compression, e.g., 'libx264' (default).
+        codec (str): Video codec to use for compression, e.g., 'libx264' (default), 'libvpx-vp9', or 'h264_nvenc'.
         crop (str): Crop settings (if any) for the video.
         resolution (str): Target resolution for the output video.
         config (str): Path to an optional configuration file for advanced ffmpeg settings.
         filename_times (bool): Flag to include timestamps in the output filename.
+        threads (int): Number of threads each ffmpeg pass may use, if specified. Set by run_batch().
+        max_bitrate (float): Upper limit for the video bitrate in kbps, if specified. Keeps short clips from
+            being encoded at needlessly high bitrates.
+        probe (dict): Optional ffprobe output for the input file, if the caller has already probed it.
+        timeout (float): Seconds each ffmpeg run may take before it is stopped, if specified.
+        always_two_pass (bool): Flag to encode short clips with two passes too, instead of a single CRF pass.
     """
 
     def __init__(
@@ -48,53 +132,45 @@ class TwoPass:
         filename_times: bool = False,
         framerate: Optional[int] = None,
         vp9_opts: Optional[dict] = None,
+        max_bitrate: Optional[float] = None,
+        threads: Optional[int] = None,
+        probe: Optional[dict] = None,
+        timeout: Optional[float] = None,
+        always_two_pass: bool = False,
     ) -> None:
 
         self.target_filesize = target_filesize
         self.crop = crop
         self.resolution = resolution
         self.times = times or {}
-        self.audio_br = audio_br
         self.codec = codec
         self.framerate = framerate
         self.output = output
         self.vp9_opts = vp9_opts or {}
+        self.max_bitrate = int(max_bitrate * 1000) if max_bitrate else None
+        self.threads = threads
+        self.timeout = timeout
+        self.always_two_pass = always_two_pass
+        self.passlogfile = None
+        # set once a stream copy came out over the target, so later runs encode instead
+        self._copy_oversized = False
+        # the job's number within run_batch(), which keeps its output file name and terminal lines apart
+        self._batch_index = None
 
         self.filename = filename
         self.fname = filename.name
+        self._safe_stem = filename.stem.replace(" ", "_")
         self.split_fname = self.fname.split(".")
 
         # create a Path from the output string
         self.output = Path(self.output).resolve()
 
-        self.probe = ffmpeg.probe(filename=filename)
-        self.duration = math.floor(float(self.probe["format"]["duration"]))
-
-        if len(self.probe["streams"]) > 2:
-            logging.warning(
-                "This media file has more than two streams, which could cause errors during the encoding job."
-            )
-
-        # Extract some information from the probe.
-        for stream in self.probe["streams"]:
-            ix = stream["index"]
-            codec_type = stream["codec_type"]
-            if codec_type == "video":
-                width = self.probe["streams"][ix]["width"]
-                height = self.probe["streams"][ix]["height"]
-                self.ratio = width / height
-
-                # Get the framerate for later comparisons
-                framerate_ratio: str = self.probe["streams"][ix].get("r_frame_rate")
-                self.init_framerate = round(int(framerate_ratio.split("/")[0]) / int(framerate_ratio.split("/")[1]))
-
-            elif codec_type == "audio":
-                audio_stream = ix
-
-        if not self.audio_br:
-            self.audio_br = float(self.probe["streams"][audio_stream]["bit_rate"])
-        else:
-            self.audio_br = self.audio_br * 1000
+        # the probe and everything read from it are cached properties that run ffprobe on first use, so a job
+        # whose times and audio bitrate are given doesn't pay for it until run()
+        if probe is not None:
+            self.probe = probe
+        if audio_br:
+            self.audio_br = audio_br * 1000
 
         # times are supplied by the file's name
         if filename_times:
@@ -123,18 +199,98 @@ class TwoPass:
             self.length = self.duration
 
         if self.length <= 0:
-            raise Exception(
-                f"""
-                Time Paradox?
+            raise Exception(_TIME_PARADOX_MSG.format(duration=self.duration / 60, times=self.times))
 
-                Something is wrong with your clipping times. Use this
-                information to further diagnose the problem:
+    @functools.cached_property
+    def probe(self) -> dict:
+        return _probe(self.filename)
 
-                - Your video is {self.duration / 60} minutes long
-                - Your clipping times are {self.times}
-                """
+    @functools.cached_property
+    def duration(self) -> int:
+        # some containers only report the duration on their streams
+        duration: str = self.probe["format"].get("duration") or next(
+            (stream["duration"] for stream in self.probe["streams"] if "duration" in stream), None
+        )
+        if duration is None:
+            raise Exception(f"Could not read the duration of {self.filename}.")
+
+        try:
+            # ffprobe prints durations like "131.248000", so the whole seconds come before the dot
+            return int(duration.split(".", 1)[0])
+        except ValueError:
+            # e.g. scientific notation
+            return math.floor(float(duration))
+
+    @functools.cached_property
+    def _streams_by_type(self) -> dict:
+        # group the streams by type once, keeping ffprobe's order
+        streams_by_type = defaultdict(list)
+        for stream in self.probe["streams"]:
+            streams_by_type[stream["codec_type"]].append(stream)
+
+        if len(streams_by_type["video"]) > 1 or len(streams_by_type["audio"]) > 1:
+            logging.warning(
+                "This media file has more than one video or audio stream, which could cause errors during the encoding job."
             )
 
+        # fail here, not halfway through an encode, when a stream the job needs is missing
+        if not streams_by_type["video"]:
+            raise ValueError(f"{self.filename} has no video stream.")
+        if not streams_by_type["audio"]:
+            raise ValueError(f"{self.filename} has no audio stream.")
+
+        return streams_by_type
+
+    @functools.cached_property
+    def ratio(self) -> float:
+        video_stream = self._streams_by_type["video"][0]
+        return video_stream["width"] / video_stream["height"]
+
+    @functools.cached_property
+    def init_video_codec(self) -> Optional[str]:
+        return self._streams_by_type["video"][0].get("codec_name")
+
+    @functools.cached_property
+    def init_video_bitrate(self) -> int:
+        return int(self._streams_by_type["video"][0].get("bit_rate", 0))
+
+    @functools.cached_property
+    def init_framerate_ratio(self) -> tuple:
+        # Get the framerate for later comparisons
+        framerate_ratio: str = self._streams_by_type["video"][0].get("r_frame_rate")
+        num, den = map(int, framerate_ratio.split("/", 1))
+        return (num, den)
+
+    @functools.cached_property
+    def init_framerate(self) -> int:
+        num, den = self.init_framerate_ratio
+        return (num + den // 2) // den
+
+    @functools.cached_property
+    def audio_br(self) -> float:
+        # only used when no audio bitrate was given
+        return float(self._streams_by_type["audio"][0]["bit_rate"])
+
+    @property
+    def crop(self) -> str:
+        return self._crop
+
+    @crop.setter
+    def crop(self, crop: Optional[str]) -> None:
+        # parse once here, so bad input fails early and apply_video_filters() doesn't split it on every run
+        self._crop = crop or ""
+        self._crop_tuple = _parse_dimensions(self._crop, 4, "crop")
+
+    @property
+    def resolution(self) -> str:
+        return self._resolution
+
+    @resolution.setter
+    def resolution(self, resolution: Optional[str]) -> None:
+        self._resolution = resolution or ""
+        self._res_tuple = _parse_dimensions(self._resolution, 2, "resolution")
+        self._output_ratio = self._res_tuple[0] / self._res_tuple[1] if self._res_tuple else None
+
     def generate_params(self, codec: str) -> dict:
         """
         Create params for the ffmpeg.output() function
@@ -142,54 +298,87 @@ class TwoPass:
         :return: dictionary containing parameters for ffmpeg's first and second pass.
         """
 
-        params = {
-            "pass1": {
-                "pass": 1,
-                "f": "null",
-                "vsync": "cfr",  # not sure if this is unique to x264 or not
-                "c:v": codec,
-            },
-            "pass2": {"pass": 2, "b:a": self.audio_br, "c:v": codec},
-        }
+        cached_params = _params_for(
+            codec=codec,
+            audio_br=self.audio_br,
+            vp9_opts=tuple(self.vp9_opts.items()),
+            bitrate=tuple(self.bitrate_dict.items()),
+            cpu_count=os.cpu_count() or 4,
+            threads=self.threads,
+        )
 
-        # assign the output framerate
-        if self.framerate:
-            if self.framerate < self.init_framerate:
-                params["pass1"]["r"] = self.framerate
-                params["pass2"]["r"] = self.framerate
-            else:
-                logging.warning(
-                    f"Your output framerate ({self.framerate}) is more than the original framerate ({self.init_framerate}). Keeping the original framerate..."
-                )
-
-        if codec == "libx264":
-            params["pass2"]["c:a"] = "aac"
-        elif codec == "libvpx-vp9":
-            row_mt = self.vp9_opts.get("row-mt", 1)
-            cpu_used = self.vp9_opts.get("cpu-used", 2)
-            deadline = self.vp9_opts.get("deadline", "good")
-
-            params["pass1"]["row-mt"] = row_mt
-            params["pass2"]["row-mt"] = row_mt
-            params["pass2"]["cpu-used"] = cpu_used
-            params["pass2"]["deadline"] = deadline
-            params["pass2"]["c:a"] = "libopus"
-
-        params["pass1"].update(**self.bitrate_dict)
-        params["pass2"].update(**self.bitrate_dict)
+        # hand out copies so callers cannot modify the cached params
+        params = {k: dict(v) for k, v in cached_params.items()}
+
+        if codec in HW_CODECS:
+            # a single hardware pass has no pass 1 stats
+            if self.passlogfile:
+                _release_stats(self.passlogfile)
+                self.passlogfile = None
+            return params
+
+        # keep the pass 1 stats out of the working directory, which may be slow or shared with other jobs
+        passlogfile = self._passlogfile(params["pass1"])
+        if passlogfile != self.passlogfile:
+            # the settings changed since the last call, give up the old stats so they don't sit in memory until exit
+            _use_stats(passlogfile)
+            if self.passlogfile:
+                _release_stats(self.passlogfile)
+            self.passlogfile = passlogfile
+        params["pass1"]["passlogfile"] = params["pass2"]["passlogfile"] = self.passlogfile
 
         return params
 
+    def _passlogfile(self, pass1: dict) -> str:
+        """
+        Name the pass 1 stats file after everything that shapes the first pass, so later runs of the same clip
+        with the same filters and encoder settings reuse the stats instead of running pass 1 again. The target
+        bitrate is left out: pass 1 records how complex each frame is, and pass 2 can spend any budget on that.
+        The source's modification time and size are part of the key, like in _probe(), so an edited file doesn't
+        reuse stale stats.
+        :param pass1: the first pass parameters from _params_for()
+        :return: the path prefix for ffmpeg's -passlogfile option
+        """
+
+        try:
+            stat = os.stat(self.filename)
+            version = [stat.st_mtime_ns, stat.st_size]
+        except OSError:
+            version = None
+
+        key_source = json.dumps(
+            [
+                str(Path(self.filename).resolve()),
+                version,
+                self.times,
+                self.crop,
+                self.resolution,
+                self._output_framerate(),
+                sorted((k, v) for k, v in pass1.items() if k != "b:v"),
+            ],
+            default=str,
+        )
+        key = hashlib.blake2b(key_source.encode(), digest_size=16).hexdigest()
+
+        return str(_stats_dir() / key)
+
     def create_bitrate_dict(self) -> None:
         """
         Perform the calculation specified in ffmpeg's documentation that generates
         the video bitrates needed to achieve the target file size
         """
-        br = math.floor((self.target_filesize * 8192) / self.length - (self.audio_br / 1000)) * 1000
+        # integer math keeps the values exact and passes them to ffmpeg without a trailing ".0"
+        target_kbits = int(self.target_filesize * 8192)
+        br = (target_kbits // self.length - int(self.audio_br) // 1000) * 1000
+
+        # short clips with a large target would otherwise get an absurd bitrate
+        if self.max_bitrate:
+            br = min(br, self.max_bitrate)
+
         self.bitrate_dict = {
             "b:v": br,
-            "minrate": br * 0.5,
-            "maxrate": br * 1.45,
+            "minrate": br // 2,
+            "maxrate": br * 29 // 20,
             "bufsize": br * 2,
         }
 
@@ -202,93 +391,256 @@ class TwoPass:
 
         If the end time is not provided, the function defaults the end time to the full video duration.
         """
-        fname = self.fname
-        times = {}
+        # a single match covers both the start time and the optional end time
+        match = _FNAME_TIMES_RE.match(self.fname)
 
-        try:
-            # Parse start time from the first six characters
-            start_time_str = f"{fname[0:2]}:{fname[2:4]}:{fname[4:6]}"
-            self.from_seconds = seconds_from_ts_string(start_time_str)
-            times["ss"] = start_time_str
-
-            # Check if there is an additional six digits for end time
-            if len(fname) > 6 and fname[7:13].isdigit():
-                end_time_str = f"{fname[7:9]}:{fname[9:11]}:{fname[11:13]}"
-                self.to_seconds = seconds_from_ts_string(end_time_str)
-                times["to"] = end_time_str
-                self.length = self.to_seconds - self.from_seconds
-            else:
-                # Default to the full duration if end time is not provided
-                times["to"] = seconds_to_timestamp(self.duration)
-                self.length = self.duration - self.from_seconds
-                self.to_seconds = self.duration
-
-        except ValueError:
+        if not match:
             # Handle any issues with timestamp parsing by defaulting to full duration
             self.length = self.duration
             self.times = {"ss": "00:00:00", "to": seconds_to_timestamp(self.duration)}
             logging.warning("Warning: Invalid time format in filename. Defaulting to full duration.")
+            return
+
+        from_h, from_m, from_s, to_h, to_m, to_s = match.groups()
+        times = {"ss": f"{from_h}:{from_m}:{from_s}"}
+        self.from_seconds = int(from_h) * 3600 + int(from_m) * 60 + int(from_s)
+
+        if to_h:
+            times["to"] = f"{to_h}:{to_m}:{to_s}"
+            self.to_seconds = int(to_h) * 3600 + int(to_m) * 60 + int(to_s)
+            self.length = self.to_seconds - self.from_seconds
+        else:
+            # Default to the full duration if end time is not provided
+            times["to"] = seconds_to_timestamp(self.duration)
+            self.length = self.duration - self.from_seconds
+            self.to_seconds = self.duration
 
         # Update instance attributes with calculated times
         self.times = times
 
+    def _output_framerate(self) -> Optional[int]:
+        """
+        Pick the framerate to convert to
+        :return: the requested framerate, or None to keep the original framerate
+        """
+
+        if self.framerate and self.framerate < self.init_framerate:
+            return self.framerate
+
+        return None
+
     def apply_video_filters(self, video):
         """
-        Function to apply the crop and resolution parameters to a video object
+        Function to apply the crop, framerate and resolution parameters to a video object
         :param video: the ffmpeg video object from the Class's input video file
-        :return: the video object after it has been cropped or resized
+        :return: the video object after it has been cropped, had frames dropped, or resized
         """
 
-        if self.crop:
-            crop = self.crop.split("x")
-            video = video.crop(x=crop[0], y=crop[1], width=crop[2], height=crop[3])
-            self.ratio = int(crop[2]) / int(crop[3])
+        if self._crop_tuple:
+            crop_x, crop_y, crop_w, crop_h = self._crop_tuple
+            video = video.crop(x=crop_x, y=crop_y, width=crop_w, height=crop_h)
+
+        framerate = self._output_framerate()
+        if framerate:
+            # drop frames before scaling, so the scaler only works on the frames that are kept
+            video = video.filter("fps", fps=framerate)
+        elif self.framerate:
+            logging.warning(
+                f"Your output framerate ({self.framerate}) is more than the original framerate ({self.init_framerate}). Keeping the original framerate..."
+            )
 
-        if self.resolution:
-            video = video.filter("scale", self.resolution)
-            x = int(self.resolution.split("x")[0])
-            y = int(self.resolution.split("x")[1])
-            outputratio = x / y
+        if self._res_tuple:
+            video = video.filter("scale", *self._res_tuple)
 
-            if self.ratio != outputratio:
-                logging.warning(
-                    """
-                    Your output resolution's aspect ratio does not match the
-                    input resolution's or your croped resolution's aspect ratio.
-                    """
-                )
+            # compare with the cropped area if there is one, without overwriting the source's ratio, so a later
+            # run without the crop (e.g. from the Web UI) checks against the right value
+            ratio = self._crop_tuple[2] / self._crop_tuple[3] if self._crop_tuple else self.ratio
+
+            # even-numbered output sizes rarely hit the exact ratio, e.g. 854x480 for a 16:9 source
+            if not math.isclose(ratio, self._output_ratio, rel_tol=0.01):
+                logging.warning(_ASPECT_RATIO_MSG)
 
         return video
 
-    def run(self) -> float:
+    def _build_output_path(self) -> str:
         """
-        Perform the CPU-intensive encoding job
-        :return: the output file's size
+        Build the output file's path from self.output, which is either a directory or a file name
+        :return: the output file's path
         """
 
         ext: str = ".webm" if self.codec == "libvpx-vp9" else ".mp4"
+
         if self.output.is_dir():
-            self.output_filename = str(
-                self.output
-                / (
-                    "small_"
-                    + self.filename.stem.replace(" ", "_")
-                    + datetime.strftime(datetime.now(), f"_%Y%m%d%H%M%S{ext}")
-                )
+            # batch jobs on the same source can finish within the same second
+            batch_suffix = f"_{self._batch_index}" if self._batch_index else ""
+            return str(self.output / f"small_{self._safe_stem}{time.strftime('_%Y%m%d%H%M%S')}{batch_suffix}{ext}")
+
+        if ext != self.output.suffix:
+            logging.warning(
+                f"You specified {self.codec}, but your output file name ends with {self.output.suffix}. I've corrected this."
             )
+
+            # correct the file suffix
+            self.output = self.output.with_suffix(ext)
+
+        return str(self.output)
+
+    def _can_copy_video(self) -> bool:
+        """
+        The source video can be copied as-is when nothing needs re-encoding: no filters, a codec the output
+        container already expects, and a bitrate within the budget.
+        The bitrate is the whole file's average, so trimmed clips are always encoded: a busy segment can run well
+        above it. A 5% margin covers the rest of the variation and the container overhead.
+        :return: whether to copy the video stream instead of encoding it
+        """
+
+        if self._copy_oversized or self.length < self.duration:
+            return False
+
+        if self.crop or self.resolution or self._output_framerate():
+            return False
+
+        if _COPY_CODECS.get(self.codec) != self.init_video_codec:
+            return False
+
+        return 0 < self.init_video_bitrate <= self.bitrate_dict["b:v"] * 19 // 20
+
+    def _should_use_crf(self) -> bool:
+        """
+        Two passes are wasted on a source whose own bitrate already fits the budget. A single capped CRF pass
+        keeps its quality and still lands under the target file size.
+        :return: whether to encode with a single CRF pass
+        """
+
+        source_br = int(self.probe["format"].get("bit_rate", 0))
+        return 0 < source_br <= self.bitrate_dict["b:v"] + self.audio_br
+
+    def _short_clip_crf(self) -> int:
+        """
+        Pick a short clip's CRF from how many bits its budget leaves for each output pixel
+        :return: the CRF for the single pass
+        """
+
+        if self._res_tuple:
+            width, height = self._res_tuple
+        elif self._crop_tuple:
+            width, height = self._crop_tuple[2:]
         else:
-            if ext != self.output.suffix:
-                logging.warning(
-                    f"You specified {self.codec}, but your output file name ends with {self.output.suffix}. I've corrected this."
-                )
+            video_stream = self._streams_by_type["video"][0]
+            width, height = video_stream["width"], video_stream["height"]
+
+        pixel_rate = width * height * (self._output_framerate() or self.init_framerate)
+        return _crf_for_bitrate(self.codec, self.bitrate_dict["b:v"], pixel_rate * _CRF_BASELINE_BPP)
+
+    def _run_ffmpeg(self, ff_output) -> None:
+        """
+        Run ffmpeg, printing how far through the clip it is, and stop it if it runs past the timeout
+        :param ff_output: the ffmpeg.output() stream to run
+        """
+
+        ff_output = ff_output.global_args("-loglevel", "quiet", "-nostats", "-progress", "pipe:2")
+        process = ff_output.run_async(cmd=_FFMPEG, pipe_stderr=True, overwrite_output=True)
+
+        # the timeout is enforced by its own timer, so it still fires when ffmpeg stalls and stops reporting progress
+        timed_out = threading.Event()
+        last_step = 0
+
+        def stop() -> None:
+            timed_out.set()
+            process.kill()
+
+        watchdog = threading.Timer(self.timeout, stop) if self.timeout else None
+        if watchdog:
+            watchdog.daemon = True
+            watchdog.start()
+
+        try:
+            # -progress writes "key=value" lines; out_time_us (out_time_ms on older builds) is the encoded position
+            for line in process.stderr:
+                key, _, value = line.decode().strip().partition("=")
+                if key in ("out_time_us", "out_time_ms") and value.isdigit():
+                    percent = min(100, int(value) // (10_000 * self.length))
+                    if not self._batch_index:
+                        print(f"\r{percent}%", end="", flush=True)
+                    elif percent // 10 > last_step:
+                        # batch jobs share the terminal, so they report every 10% on a line of their own
+                        last_step = percent // 10
+                        self._print(f"{percent}%")
+        except BaseException:
+            # e.g. Ctrl+C, don't leave ffmpeg running in the background
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            if watchdog:
+                watchdog.cancel()
+
+        if not self._batch_index:
+            print()
+        returncode = process.wait()
+        if timed_out.is_set():
+            raise TimeoutError(f"ffmpeg did not finish within {self.timeout} seconds.")
+        if returncode != 0:
+            raise ffmpeg.Error("ffmpeg", None, None)
+
+    def _print(self, message: str) -> None:
+        """
+        Print a message for the user, prefixed with the job's number when it runs in a batch
+        :param message: the message to print
+        """
+
+        print(f"[job {self._batch_index}] {message}" if self._batch_index else message)
+
+    def _run_single_pass(self, video, audio, params: dict, message: str) -> None:
+        """
+        Encode the output file with one ffmpeg run
+        :param video: the filtered ffmpeg video stream
+        :param audio: the ffmpeg audio stream
+        :param params: the ffmpeg.output() parameters for the run
+        :param message: what to tell the user before the run starts
+        """
+
+        self._print(message)
+        self._run_ffmpeg(ffmpeg.output(video, audio, self.output_filename, **params))
+
+    def _run_two_pass(self, video, audio, params: dict) -> None:
+        """
+        Run ffmpeg's first and second pass, skipping the first pass when its stats already exist
+        :param video: the filtered ffmpeg video stream
+        :param audio: the ffmpeg audio stream
+        :param params: the parameters from generate_params()
+        """
+
+        # jobs with the same first pass wait for each other, so pass 1 runs once and the others reuse its stats
+        with _STATS_LOCKS[self.passlogfile]:
+            if Path(f"{self.passlogfile}-0.log").exists():
+                self._print("Reusing the first pass stats from an earlier run")
+            else:
+                try:
+                    # First Pass
+                    self._print("Performing first pass")
+                    self._run_ffmpeg(ffmpeg.output(video, os.devnull, **params["pass1"]))
+                except BaseException:
+                    # don't leave partial stats (e.g. "-0.log.temp" or "-0.log.mbtree") for a later run to pick up
+                    for file in glob(f"{self.passlogfile}*"):
+                        Path(file).unlink()
+                    raise
+
+        # Second Pass
+        self._print("Performing second pass")
+        self._run_ffmpeg(ffmpeg.output(video, audio, self.output_filename, **params["pass2"]))
+
+    def run(self) -> float:
+        """
+        Perform the CPU-intensive encoding job
+        :return: the output file's size
+        """
 
-                # correct the file suffix
-                if self.codec == "libvpx-vp9":
-                    self.output = self.output.with_suffix(".webm")
-                else:
-                    self.output = self.output.with_suffix(".mp4")
+        self.output_filename = self._build_output_path()
 
-            self.output_filename = str(self.output)
+        if self.codec in HW_CODECS and not _hw_encoder_works(self.codec):
+            logging.warning(f"{self.codec} is not available on this machine. Falling back to libx264...")
+            self.codec = "libx264"
 
         # generate run parameters
         self.create_bitrate_dict()
@@ -299,26 +651,433 @@ class TwoPass:
         video = self.apply_video_filters(ffinput.video)
         audio = ffinput.audio
 
-        # First Pass
-        ffOutput = ffmpeg.output(video, "pipe:", **params["pass1"])
-        ffOutput = ffOutput.global_args("-loglevel", "quiet", "-stats")
-        print("Performing first pass")
-        std_out, std_err = ffOutput.run(capture_stdout=True)
+        copy_video = self._can_copy_video()
+        if copy_video:
+            copy_params = {k: v for k, v in params["pass2"].items() if k in ("b:a", "c:a", "movflags")}
+            self._run_single_pass(
+                video,
+                audio,
+                {"c:v": "copy", **copy_params},
+                "The source video already fits the target bitrate. Copying it and encoding the audio",
+            )
+        elif self.codec in HW_CODECS:
+            # hardware encoders do their own multipass rate control within one run
+            self._run_single_pass(video, audio, params["pass2"], f"Performing a single {self.codec} pass")
+        elif self._should_use_crf():
+            self._run_single_pass(
+                video,
+                audio,
+                _crf_params(params["pass2"], self.codec, self.length),
+                "The source already fits the target bitrate. Performing a single pass",
+            )
+        elif self.length <= _SHORT_CLIP_SECONDS and not self.always_two_pass:
+            self._run_single_pass(
+                video,
+                audio,
+                _crf_params(params["pass2"], self.codec, self.length, self._short_clip_crf()),
+                "Short clip. Performing a single pass",
+            )
+        else:
+            self._run_two_pass(video, audio, params)
 
-        # Second Pass
-        ffOutput = ffmpeg.output(video, audio, self.output_filename, **params["pass2"])
-        ffOutput = ffOutput.global_args("-loglevel", "quiet", "-stats")
-        print("\nPerforming second pass")
-        ffOutput.run(overwrite_output=True)
+        # save the output file size (MiB) and return it
+        self.output_filesize = os.path.getsize(self.output_filename) / (1 << 20)
 
-        # save the output file size and return it
-        self.output_filesize = os.path.getsize(self.output_filename) * 0.00000095367432
+        if copy_video and self.output_filesize >= self.target_filesize:
+            # a lower target can't shrink a copied stream, so the file size loop's next run has to encode
+            self._copy_oversized = True
 
         return self.output_filesize
 
+    @staticmethod
+    def run_batch(jobs: list, workers: Optional[int] = None) -> list:
+        """
+        Encode independent jobs side by side. Each job's ffmpeg is limited to its share of the CPU cores.
+        Jobs that write to an output directory get their number appended to the file name, so several jobs
+        on the same source file don't overwrite each other. Jobs must not share an output file name.
+        :param jobs: the TwoPass instances to run
+        :param workers: the most jobs to run at once, defaults to half of the CPU cores
+        :return: the output file sizes, in the same order as the jobs
+        """
+
+        output_files = [job.output for job in jobs if not job.output.is_dir()]
+        if len(set(output_files)) != len(output_files):
+            raise ValueError("Several jobs in the batch write to the same output file.")
+
+        cpu_count = os.cpu_count() or 4
+        # a small batch shares the cores between fewer, wider jobs
+        workers = max(1, min(workers or cpu_count // 2, len(jobs)))
+
+        for index, job in enumerate(jobs, start=1):
+            job.threads = job.threads or max(1, cpu_count // workers)
+            job._batch_index = index
+
+        # the work happens in ffmpeg subprocesses, so threads are enough to keep them all busy
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(lambda job: job.run(), jobs))
+
+
+@functools.cache
+def _ffmpeg_encoders() -> str:
+    """
+    List the encoders compiled into ffmpeg. This runs ffmpeg once per process.
+    """
+    try:
+        result = subprocess.run([_FFMPEG, "-hide_banner", "-encoders"], capture_output=True, text=True)
+    except OSError:
+        return ""
+    return result.stdout
+
+
+@functools.cache
+def _hw_encoder_works(codec: str) -> bool:
+    """
+    Check that a hardware encoder can actually start. Most ffmpeg builds include NVENC even on machines without
+    an NVIDIA GPU or driver, where it only fails once an encode begins. This runs ffmpeg once per encoder.
+    :param codec: the hardware encoder, e.g. "h264_nvenc"
+    :return: whether a one frame test encode succeeded
+    """
+
+    if codec not in _ffmpeg_encoders():
+        return False
+
+    # NVENC rejects very small frames, so the test frame is 256x256
+    test_encode = [_FFMPEG, "-hide_banner", "-loglevel", "error", "-f", "lavfi", "-i", "color=size=256x256"]
+    test_encode += ["-frames:v", "1", "-c:v", codec, "-f", "null", "-"]
+    try:
+        result = subprocess.run(test_encode, capture_output=True, text=True, timeout=30)
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+    if result.returncode != 0:
+        logging.info(f"{codec} test encode failed: {result.stderr.strip()}")
+    return result.returncode == 0
+
+
+def _use_stats(passlogfile: str) -> None:
+    """
+    Register a TwoPass instance as a user of a pass 1 stats file, creating the file's lock for the first user
+    :param passlogfile: the stats file's path prefix
+    """
+
+    with _STATS_LOCK:
+        _STATS_USERS[passlogfile] += 1
+        _STATS_LOCKS.setdefault(passlogfile, threading.Lock())
+
+
+def _release_stats(passlogfile: str) -> None:
+    """
+    Unregister a user of a pass 1 stats file. The last user deletes the stats and their lock, jobs that share
+    them keep them for as long as any of them may still run pass 2.
+    :param passlogfile: the stats file's path prefix
+    """
+
+    with _STATS_LOCK:
+        _STATS_USERS[passlogfile] -= 1
+        if _STATS_USERS[passlogfile] > 0:
+            return
+
+        # nobody can pick the file up again without _STATS_LOCK, so it is safe to delete here
+        del _STATS_USERS[passlogfile], _STATS_LOCKS[passlogfile]
+        for file in glob(f"{passlogfile}*"):
+            Path(file).unlink(missing_ok=True)
+
+
+@functools.cache
+def _stats_dir() -> Path:
+    """
+    Create this process's directory for pass 1 stats files, which is removed again at exit. It goes in /dev/shm
+    when available, since that is memory-backed on Linux and pass 2 reads the stats back without touching the
+    disk. x264 .mbtree stats can run to hundreds of MB and containers often cap /dev/shm at 64 MB, so it is only
+    used when it has room to spare. Otherwise, and on other systems, the regular temp directory is used.
+    """
+
+    shm = Path("/dev/shm")
+    parent = None
+    if shm.is_dir() and os.access(shm, os.W_OK):
+        try:
+            if shutil.disk_usage(shm).free >= _SHM_MIN_FREE:
+                parent = shm
+        except OSError:
+            pass
+    stats_dir = tempfile.mkdtemp(prefix="f4d_", dir=parent)
+    atexit.register(shutil.rmtree, stats_dir, ignore_errors=True)
+
+    return Path(stats_dir)
+
+
+@functools.lru_cache(maxsize=128)
+def _probe_cached(filename: str, mtime_ns: int, size: int) -> dict:
+    """
+    Run ffprobe once per version of a file. Results are kept in memory and on disk, keyed on the path,
+    modification time and size, so an edited file is probed again.
+    """
+
+    probe_args = _probe_args(filename)
+    cache_dir = _probe_cache_dir()
+    if cache_dir is None:
+        return ffmpeg.probe(filename=filename, cmd=_FFPROBE, **probe_args)
+
+    key_source = f"{filename}:{mtime_ns}:{size}:{sorted(probe_args.items())}"
+    key = hashlib.blake2b(key_source.encode(), digest_size=16).hexdigest()
+    cache_file = cache_dir / f"{key}.json"
+
+    try:
+        probe = json.loads(cache_file.read_text())
+        # mark the entry as recently used, so _prune_probe_cache() keeps it
+        os.utime(cache_file)
+        return probe
+    except (OSError, ValueError):
+        pass
+
+    probe = ffmpeg.probe(filename=filename, cmd=_FFPROBE, **probe_args)
+
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file and rename it, so a parallel job never reads a half-written cache entry
+        with tempfile.NamedTemporaryFile("w", dir=cache_dir, suffix=".tmp", delete=False) as tmp:
+            json.dump(probe, tmp)
+        os.replace(tmp.name, cache_file)
+        _prune_probe_cache(cache_dir)
+    except OSError:
+        logging.warning(f"Could not write the probe cache to {cache_dir}.")
+
+    return probe
+
+
+def _probe_cache_dir() -> Optional[Path]:
+    """
+    Find the probe cache directory on first use rather than at import time, since looking up the home directory
+    fails when e.g. HOME is unset
+    :return: the directory, or None when there is no place for the cache
+    """
+
+    global PROBE_CACHE_DIR
+
+    if PROBE_CACHE_DIR is None:
+        try:
+            cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+        except (RuntimeError, KeyError):
+            return None
+        PROBE_CACHE_DIR = Path(cache_home) / "ffmpeg4discord" / "probes"
+
+    return PROBE_CACHE_DIR
+
+
+def _prune_probe_cache(cache_dir: Path) -> None:
+    """
+    Delete the least recently used probe results beyond the newest _PROBE_CACHE_ENTRIES, so the cache doesn't
+    grow with every file that was ever probed
+    :param cache_dir: the probe cache directory
+    """
+
+    entries = list(cache_dir.glob("*.json"))
+    if len(entries) <= _PROBE_CACHE_ENTRIES:
+        return
+
+    def last_used(path: Path) -> float:
+        try:
+            return path.stat().st_mtime
+        except OSError:
+            # already deleted by a parallel job
+            return 0
+
+    entries.sort(key=last_used, reverse=True)
+    for path in entries[_PROBE_CACHE_ENTRIES:]:
+        path.unlink(missing_ok=True)
+
+
+def _probe_args(filename) -> dict:
+    """
+    Pick the ffprobe options for a file
+    :param filename: the file to probe
+    :return: the keyword arguments for ffmpeg.probe()
+    """
+
+    if Path(filename).suffix.lower() in _HEADER_METADATA_SUFFIXES:
+        return {**_PROBE_ARGS, **_PROBE_LIMITS}
+
+    return _PROBE_ARGS
 
+
+def _probe(filename: Path) -> dict:
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        # let ffprobe report on files we cannot stat
+        return ffmpeg.probe(filename=filename, cmd=_FFPROBE, **_probe_args(filename))
+
+    # the absolute path, so the same file reached through different relative paths shares one entry
+    return _probe_cached(str(Path(filename).resolve()), stat.st_mtime_ns, stat.st_size)
+
+
+def _parse_dimensions(value: str, count: int, name: str) -> Optional[tuple]:
+    """
+    Split a "WxH" style string into integers
+    :param value: the string to parse, e.g. "1280x720" or "0x0x1280x720"
+    :param count: how many numbers the string must contain
+    :param name: the setting's name, used in the error message
+    :return: a tuple of ints, or None if the value is empty
+    """
+
+    if not value:
+        return None
+
+    parts = value.lower().split("x")
+    if len(parts) != count or not all(part.strip().isdigit() for part in parts):
+        raise ValueError(f"Invalid {name} '{value}'. Expected {count} whole numbers separated by 'x'.")
+
+    numbers = tuple(int(part) for part in parts)
+
+    # the last two numbers are a width and height, only the crop's x and y offsets may be 0
+    if min(numbers[-2:]) <= 0:
+        raise ValueError(f"Invalid {name} '{value}'. The width and height must be greater than 0.")
+
+    return numbers
+
+
+def prefetch_probes(filenames: list, workers: Optional[int] = None) -> None:
+    """
+    Probe several files at the same time to fill the probe cache, so building a TwoPass job for each of them
+    doesn't wait on one ffprobe process after another.
+    :param filenames: paths of the files to probe
+    :param workers: the number of ffprobe processes to run at once, defaults to the number of CPU cores
+    """
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        list(executor.map(_probe, filenames))
+
+
+@functools.cache
+def _params_for(
+    codec: str,
+    audio_br: float,
+    vp9_opts: tuple,
+    bitrate: tuple,
+    cpu_count: int,
+    threads: Optional[int] = None,
+) -> MappingProxyType:
+    """
+    Build the read-only ffmpeg.output() parameters for both passes. Results are cached, so repeated runs with
+    the same settings (e.g. re-encoding from the Web UI) skip rebuilding them. The file size loop lowers the
+    bitrate on every retry, which is part of the key, so its runs build new parameters.
+    """
+
+    params = {
+        "pass1": {
+            "pass": 1,
+            "f": "null",
+            "c:v": codec,
+            "an": None,
+        },
+        "pass2": {"pass": 2, "b:a": audio_br, "c:v": codec},
+    }
+
+    # the fps filter already sets the output framerate, and both passes must emit the same frames
+    # for pass 2 to line up with the pass 1 stats, so neither pass duplicates or drops any more.
+    # -vsync rather than -fps_mode, which only exists since ffmpeg 5.1
+    params["pass1"]["vsync"] = params["pass2"]["vsync"] = "passthrough"
+
+    if threads:
+        # run_batch() splits the cores between jobs; VP9 below may override this with its own threads option
+        params["pass1"]["threads"] = params["pass2"]["threads"] = threads
+
+    if codec == "h264_nvenc":
+        # NVENC's own two-pass mode, run by _run_single_pass()
+        params["pass2"]["rc"] = "vbr"
+        params["pass2"]["multipass"] = "fullres"
+        params["pass2"]["c:a"] = "aac"
+        params["pass2"]["movflags"] = "+faststart"
+    elif codec == "libx264":
+        # the first pass only gathers stats; "fast" keeps the B-frame and mbtree settings that pass 2 checks for
+        params["pass1"]["preset"] = "fast"
+        params["pass2"]["c:a"] = "aac"
+        # put the moov atom up front so Discord's player can start before the whole file has downloaded
+        params["pass2"]["movflags"] = "+faststart"
+    elif codec == "libvpx-vp9":
+        vp9_opts = dict(vp9_opts)
+        row_mt = vp9_opts.get("row-mt", 1)
+        cpu_used = vp9_opts.get("cpu-used", 2)
+        deadline = vp9_opts.get("deadline", "good")
+        # libvpx only scales past a few cores with tile columns (log2, capped at 6) and explicit threads
+        tile_columns = vp9_opts.get("tile-columns", min(6, max(1, int(math.log2(cpu_count)))))
+        threads = vp9_opts.get("threads", threads or cpu_count)
+
+        for pass_params in (params["pass1"], params["pass2"]):
+            pass_params["row-mt"] = row_mt
+            pass_params["tile-columns"] = tile_columns
+            pass_params["threads"] = threads
+
+        # the WebM project's recommended first-pass speed
+        params["pass1"]["cpu-used"] = 4
+        params["pass2"]["cpu-used"] = cpu_used
+        params["pass2"]["deadline"] = deadline
+        params["pass2"]["c:a"] = "libopus"
+
+    # pass 1 only gathers stats for the average bitrate, so it skips the VBV constraints
+    bitrate = dict(bitrate)
+    params["pass1"]["b:v"] = bitrate["b:v"]
+    params["pass2"].update(bitrate)
+
+    if codec in HW_CODECS:
+        # hardware encoders run once, see TwoPass.run(), so they need neither pass 1 nor the pass numbers
+        del params["pass1"], params["pass2"]["pass"]
+
+    return MappingProxyType({k: MappingProxyType(v) for k, v in params.items()})
+
+
+def _crf_for_bitrate(codec: str, bitrate: int, baseline: float) -> int:
+    """
+    Estimate the CRF that lands near a bitrate. Every doubling of the bitrate is worth about 6 CRF steps,
+    counted from the codec's usual CRF at the baseline bitrate.
+    :param codec: ffmpeg video codec to use during encoding
+    :param bitrate: the target video bitrate
+    :param baseline: the bitrate at which the codec's usual CRF fits
+    :return: the CRF, within the codec's range from _SHORT_CLIP_CRF
+    """
+
+    usual, lowest, highest = _SHORT_CLIP_CRF[codec]
+    if bitrate <= 0:
+        return highest
+
+    return min(highest, max(lowest, round(usual - 6 * math.log2(bitrate / baseline))))
+
+
+def _crf_params(params: dict, codec: str, length: Optional[int] = None, crf: Optional[int] = None) -> dict:
+    """
+    Turn the second pass parameters into a single constrained quality pass. The target video bitrate becomes
+    a ceiling, so the output still lands under the target file size.
+    :param params: the second pass parameters from generate_params()
+    :param codec: ffmpeg video codec to use during encoding
+    :param length: the clip's length in seconds, to hold x264 strictly to the budget when nothing else bounds
+        the bitrate (e.g. a short clip from a high bitrate source)
+    :param crf: the CRF to use, defaults to the codec's value from _CRF
+    :return: dictionary containing parameters for a single ffmpeg pass
+    """
+
+    params = {k: v for k, v in params.items() if k not in ("pass", "passlogfile", "minrate")}
+    params["crf"] = crf or _CRF[codec]
+
+    if codec == "libx264":
+        params["maxrate"] = params.pop("b:v")
+        if length:
+            # x264's buffer starts 90% full, so the whole clip stays under maxrate * (length + 1) bits
+            params["maxrate"] = params["bufsize"] = params["maxrate"] * length // (length + 1)
+    else:
+        # libvpx-vp9 caps constrained quality at b:v by itself
+        del params["maxrate"], params["bufsize"]
+
+    return params
+
+
+@functools.lru_cache(maxsize=256)
 def seconds_from_ts_string(ts_string: str):
-    return int(ts_string[0:2]) * 60 * 60 + int(ts_string[3:5]) * 60 + int(ts_string[6:8])
+    match = _TS_RE.match(ts_string)
+    if not match:
+        raise ValueError(f"Invalid timestamp: {ts_string}. Use the HH:MM:SS format.")
+
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
 
 
 def seconds_to_timestamp(seconds: int) -> str:
@@ -0,0 +1,47 @@
+import io
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from ffmpeg4discord.arguments import get_args, load_config
+
+
+class TestArguments(unittest.TestCase):
+    def test_load_config(self):
+        config = load_config(io.StringIO('{"target_filesize": 25, "timeout": 300}'))
+        self.assertEqual(config, {"target_filesize": 25, "timeout": 300})
+
+    def test_get_args(self):
+        args = get_args(["clip.mp4", "--max-bitrate", "8000", "--timeout", "600", "--from", "00:00:10"])
+
+        self.assertEqual(args["filename"], "clip.mp4")
+        self.assertEqual(args["max_bitrate"], 8000.0)
+        self.assertEqual(args["timeout"], 600.0)
+        self.assertEqual(args["times"], {"from": "00:00:10"})
+        self.assertNotIn("port", args)
+        self.assertNotIn("config", args)
+
+        # both options are off unless given
+        args = get_args(["clip.mp4"])
+        self.assertIsNone(args["max_bitrate"])
+        self.assertIsNone(args["timeout"])
+        self.assertFalse(args["always_two_pass"])
+
+        args = get_args(["clip.mp4", "--always-two-pass"])
+        self.assertTrue(args["always_two_pass"])
+
+    def test_get_args_config(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config_file = Path(tmp_dir) / "config.json"
+            config_file.write_text(json.dumps({"max_bitrate": 4000, "timeout": 120, "target_filesize": 25}))
+
+            # the config fills in options left unset, the command line wins over it
+            args = get_args(["clip.mp4", "--config", str(config_file), "--timeout", "60"])
+
+        self.assertEqual(args["max_bitrate"], 4000)
+        self.assertEqual(args["timeout"], 60.0)
+        self.assertEqual(args["target_filesize"], 25)
+
+
+if __name__ == "__main__":
+    unittest.main()
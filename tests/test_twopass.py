@@ -1,6 +1,16 @@
+import tempfile
+import threading
 import unittest
-from unittest.mock import patch, MagicMock
-from ffmpeg4discord.twopass import TwoPass
+import ffmpeg
+from unittest.mock import patch, MagicMock, call
+from ffmpeg4discord.twopass import (
+    TwoPass,
+    _hw_encoder_works,
+    _probe,
+    _probe_cached,
+    _stats_dir,
+    prefetch_probes,
+)
 from pathlib import Path
 
 
@@ -51,6 +61,44 @@ class TestTwoPass(unittest.TestCase):
         self.assertEqual(twopass.from_seconds, 60)
         self.assertEqual(twopass.times, {"ss": "00:01:00", "to": "01:00:00"})
 
+    @patch("ffmpeg4discord.twopass.ffmpeg.probe")
+    def test_time_from_file_name_start_and_end(self, mock_probe: MagicMock):
+        # Set up mock values for the probe
+        mock_probe.return_value = {
+            "streams": [
+                {"index": 0, "codec_type": "video", "width": 1280, "height": 720, "r_frame_rate": "60/1"},
+                {"index": 1, "codec_type": "audio", "bit_rate": "128000"},
+            ],
+            "format": {"duration": "3600"},
+        }
+
+        # Create TwoPass instance with start and end times in the file name
+        twopass = TwoPass(Path("000020-000145.mp4"), self.target_filesize, filename_times=True)
+
+        # Check attributes
+        self.assertEqual(twopass.from_seconds, 20)
+        self.assertEqual(twopass.to_seconds, 105)
+        self.assertEqual(twopass.length, 85)
+        self.assertEqual(twopass.times, {"ss": "00:00:20", "to": "00:01:45"})
+
+    @patch("ffmpeg4discord.twopass.ffmpeg.probe")
+    def test_time_from_file_name_invalid(self, mock_probe: MagicMock):
+        # Set up mock values for the probe
+        mock_probe.return_value = {
+            "streams": [
+                {"index": 0, "codec_type": "video", "width": 1280, "height": 720, "r_frame_rate": "60/1"},
+                {"index": 1, "codec_type": "audio", "bit_rate": "128000"},
+            ],
+            "format": {"duration": "3600"},
+        }
+
+        # Create TwoPass instance with a file name that has no times
+        twopass = TwoPass(Path("SomethingElse.mp4"), self.target_filesize, filename_times=True)
+
+        # Check that the whole video is used
+        self.assertEqual(twopass.length, 3600)
+        self.assertEqual(twopass.times, {"ss": "00:00:00", "to": "01:00:00"})
+
     @patch("ffmpeg4discord.twopass.ffmpeg.probe")
     def test_create_bitrate_dict(self, mock_probe: MagicMock):
         # Set up mock values for the probe
@@ -74,6 +122,412 @@ class TestTwoPass(unittest.TestCase):
         self.assertEqual(twopass.bitrate_dict["maxrate"], 4763250)
         self.assertEqual(twopass.bitrate_dict["bufsize"], 6570000)
 
+    @patch("ffmpeg4discord.twopass.ffmpeg.probe")
+    def test_init_stream_order(self, mock_probe: MagicMock):
+        # Set up mock values for a probe with audio first and a subtitle stream
+        mock_probe.return_value = {
+            "streams": [
+                {"index": 0, "codec_type": "audio", "bit_rate": "128000"},
+                {"index": 1, "codec_type": "subtitle"},
+                {"index": 2, "codec_type": "video", "width": 1920, "height": 1080, "r_frame_rate": "30000/1001"},
+            ],
+            "format": {"duration": "3600"},
+        }
+
+        # Create TwoPass instance
+        twopass = TwoPass(self.filename, self.target_filesize, audio_br=None)
+
+        # Check attributes
+        self.assertEqual(twopass.ratio, 1920 / 1080)
+        self.assertEqual(twopass.init_framerate, 30)
+        self.assertEqual(twopass.init_framerate_ratio, (30000, 1001))
+        self.assertEqual(twopass.audio_br, 128000)
+
+    @patch("ffmpeg4discord.twopass.ffmpeg.probe")
+    def test_init_with_probe(self, mock_probe: MagicMock):
+        probe = {
+            "streams": [
+                {"index": 0, "codec_type": "video", "width": 1280, "height": 720, "r_frame_rate": "60/1"},
+                {"index": 1, "codec_type": "audio", "bit_rate": "128000"},
+            ],
+            "format": {"duration": "3600"},
+        }
+
+        # Create TwoPass instance with an existing probe
+        twopass = TwoPass(self.filename, self.target_filesize, probe=probe)
+
+        # ffprobe should not run again
+        mock_probe.assert_not_called()
+        self.assertIs(twopass.probe, probe)
+        self.assertEqual(twopass.duration, 3600)
+
+    def test_init_stream_duration(self):
+        probe = {
+            "streams": [
+                {"index": 0, "codec_type": "video", "width": 1280, "height": 720, "r_frame_rate": "60/1"},
+                {"index": 1, "codec_type": "audio", "bit_rate": "128000", "duration": "95.040000"},
+            ],
+            "format": {},
+        }
+
+        # fall back to the stream duration when the container has none
+        twopass = TwoPass(self.filename, self.target_filesize, probe=probe)
+        self.assertEqual(twopass.duration, 95)
+
+    def test_init_no_audio(self):
+        probe = {
+            "streams": [
+                {"index": 0, "codec_type": "video", "width": 1280, "height": 720, "r_frame_rate": "60/1"},
+            ],
+            "format": {"duration": "3600"},
+        }
+
+        twopass = TwoPass(self.filename, self.target_filesize, audio_br=96, probe=probe)
+
+        # the streams are checked the first time they are needed
+        with self.assertRaises(ValueError):
+            twopass.init_framerate
+
+    @patch("ffmpeg4discord.twopass.ffmpeg.probe")
+    def test_init_lazy_probe(self, mock_probe: MagicMock):
+        mock_probe.return_value = {
+            "streams": [
+                {"index": 0, "codec_type": "video", "width": 1280, "height": 720, "r_frame_rate": "60/1"},
+                {"index": 1, "codec_type": "audio", "bit_rate": "128000"},
+            ],
+            "format": {"duration": "3600"},
+        }
+
+        # the clip's length and audio bitrate are known, so ffprobe can wait
+        twopass = TwoPass(
+            self.filename, self.target_filesize, times={"from": "00:00:10", "to": "00:00:20"}, audio_br=96
+        )
+        mock_probe.assert_not_called()
+        self.assertEqual(twopass.length, 10)
+
+        # the first probe-derived attribute runs ffprobe, once
+        self.assertEqual(twopass.ratio, 1280 / 720)
+        self.assertEqual(twopass.init_framerate, 60)
+        mock_probe.assert_called_once()
+
+    def test_crop_and_resolution(self):
+        probe = {
+            "streams": [
+                {"index": 0, "codec_type": "video", "width": 1280, "height": 720, "r_frame_rate": "60/1"},
+                {"index": 1, "codec_type": "audio", "bit_rate": "128000"},
+            ],
+            "format": {"duration": "3600"},
+        }
+
+        twopass = TwoPass(self.filename, self.target_filesize, crop="0x0x640x360", resolution="1280x720", probe=probe)
+
+        # the strings are kept for the Web UI and parsed once
+        self.assertEqual(twopass.crop, "0x0x640x360")
+        self.assertEqual(twopass._crop_tuple, (0, 0, 640, 360))
+        self.assertEqual(twopass._res_tuple, (1280, 720))
+
+        twopass.resolution = "854X480"
+        self.assertEqual(twopass._res_tuple, (854, 480))
+
+        twopass.resolution = None
+        self.assertEqual(twopass.resolution, "")
+        self.assertIsNone(twopass._res_tuple)
+
+        with self.assertRaises(ValueError):
+            twopass.crop = "640x360"
+
+        # a zero width or height is rejected up front instead of dividing by it later
+        with self.assertRaises(ValueError):
+            twopass.resolution = "1280x0"
+
+        with self.assertRaises(ValueError):
+            twopass.crop = "0x0x0x360"
+
+    @patch("ffmpeg4discord.twopass.ffmpeg.probe")
+    def test_create_bitrate_dict_max_bitrate(self, mock_probe: MagicMock):
+        # Set up mock values for the probe
+        mock_probe.return_value = {
+            "streams": [
+                {"index": 0, "codec_type": "video", "width": 1280, "height": 720, "r_frame_rate": "60/1"},
+                {"index": 1, "codec_type": "audio", "bit_rate": "128000"},
+            ],
+            "format": {"duration": "120"},
+        }
+
+        # Create TwoPass instance with a 2000kbps cap
+        twopass = TwoPass(self.filename, self.target_filesize, max_bitrate=2000)
+
+        # Call create_bitrate_dict
+        twopass.create_bitrate_dict()
+
+        # Check that the cap was applied
+        self.assertEqual(twopass.bitrate_dict["b:v"], 2000000)
+        self.assertEqual(twopass.bitrate_dict["maxrate"], 2900000)
+
+    @patch("ffmpeg4discord.twopass.atexit.register")
+    @patch("ffmpeg4discord.twopass.shutil.disk_usage")
+    def test_stats_dir_small_shm(self, mock_disk_usage: MagicMock, mock_register: MagicMock):
+        # a container's 64 MB /dev/shm can't hold the pass 1 stats of a long clip
+        mock_disk_usage.return_value = MagicMock(free=64 << 20)
+
+        stats_dir = _stats_dir.__wrapped__()
+        try:
+            self.assertEqual(stats_dir.parent, Path(tempfile.gettempdir()))
+        finally:
+            stats_dir.rmdir()
+
+    @patch("ffmpeg4discord.twopass.ffmpeg.probe")
+    def test_probe_disk_cache(self, mock_probe: MagicMock):
+        mock_probe.return_value = {
+            "streams": [
+                {"index": 0, "codec_type": "video", "width": 1280, "height": 720, "r_frame_rate": "60/1"},
+                {"index": 1, "codec_type": "audio", "bit_rate": "128000"},
+            ],
+            "format": {"duration": "3600"},
+        }
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            video_file = Path(tmp_dir) / "000100.mp4"
+            video_file.write_bytes(b"not really a video")
+
+            with patch("ffmpeg4discord.twopass.PROBE_CACHE_DIR", Path(tmp_dir) / "probes"):
+                first = _probe(video_file)
+                _probe_cached.cache_clear()
+                second = _probe(video_file)
+                cache_files = [path.name for path in (Path(tmp_dir) / "probes").iterdir()]
+
+        # one finished cache entry, no temporary files left behind
+        self.assertEqual(len(cache_files), 1)
+        self.assertTrue(cache_files[0].endswith(".json"))
+
+        # the second probe is read from disk instead of running ffprobe
+        mock_probe.assert_called_once()
+        self.assertIn("show_entries", mock_probe.call_args.kwargs)
+        self.assertEqual(mock_probe.call_args.kwargs["probesize"], "1M")
+        self.assertEqual(first, second)
+
+    @patch("ffmpeg4discord.twopass._PROBE_CACHE_ENTRIES", 2)
+    @patch("ffmpeg4discord.twopass.ffmpeg.probe")
+    def test_probe_cache_pruning(self, mock_probe: MagicMock):
+        mock_probe.return_value = {"streams": [], "format": {"duration": "3600"}}
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with patch("ffmpeg4discord.twopass.PROBE_CACHE_DIR", Path(tmp_dir) / "probes"):
+                for name in ("000100.mp4", "000200.mp4", "000300.mp4"):
+                    video_file = Path(tmp_dir) / name
+                    video_file.write_bytes(b"not really a video")
+                    _probe(video_file)
+
+            cache_files = list((Path(tmp_dir) / "probes").iterdir())
+
+        # only the newest entries are kept
+        self.assertEqual(len(cache_files), 2)
+
+    @patch("ffmpeg4discord.twopass.Path.home", side_effect=RuntimeError("Could not determine home directory."))
+    @patch("ffmpeg4discord.twopass.ffmpeg.probe")
+    def test_probe_without_home(self, mock_probe: MagicMock, mock_home: MagicMock):
+        mock_probe.return_value = {"streams": [], "format": {"duration": "3600"}}
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            video_file = Path(tmp_dir) / "000100.mp4"
+            video_file.write_bytes(b"not really a video")
+
+            # without a home directory the probe still runs, it just isn't cached on disk
+            with patch("ffmpeg4discord.twopass.PROBE_CACHE_DIR", None), patch.dict("os.environ", clear=True):
+                self.assertEqual(_probe(video_file), mock_probe.return_value)
+
+        mock_home.assert_called_once()
+
+    @patch("ffmpeg4discord.twopass.ffmpeg.probe")
+    def test_probe_without_header_metadata(self, mock_probe: MagicMock):
+        # MPEG-TS keeps no duration in its headers, so ffprobe reads as much of it as it needs
+        _probe(Path("recording.ts"))
+
+        self.assertIn("show_entries", mock_probe.call_args.kwargs)
+        self.assertNotIn("probesize", mock_probe.call_args.kwargs)
+        self.assertNotIn("analyzeduration", mock_probe.call_args.kwargs)
+
+    def test_apply_video_filters(self):
+        probe = {
+            "streams": [
+                {"index": 0, "codec_type": "video", "width": 1920, "height": 1080, "r_frame_rate": "60/1"},
+                {"index": 1, "codec_type": "audio", "bit_rate": "128000"},
+            ],
+            "format": {"duration": "3600"},
+        }
+
+        twopass = TwoPass(self.filename, self.target_filesize, resolution="1280x720", framerate=30, probe=probe)
+        video = twopass.apply_video_filters(ffmpeg.input("input.mp4").video)
+        args = ffmpeg.output(video, "output.mp4").get_args()
+
+        # frames are dropped before they reach the scaler, and -r is not used
+        self.assertIn("[0:v]fps=fps=30[s0];[s0]scale=1280:720[s1]", args)
+        self.assertNotIn("-r", args)
+
+        # cropping leaves the source's aspect ratio alone
+        twopass.crop = "420x0x1080x1080"
+        twopass.apply_video_filters(ffmpeg.input("input.mp4").video)
+        self.assertEqual(twopass.ratio, 1920 / 1080)
+
+    def test_run_ffmpeg_progress(self):
+        twopass = TwoPass(
+            self.filename, self.target_filesize, times={"from": "00:00:00", "to": "00:01:40"}, audio_br=96
+        )
+
+        mock_output = MagicMock()
+        process = mock_output.global_args.return_value.run_async.return_value
+        process.stderr = iter([b"out_time_us=50000000\n", b"progress=continue\n"])
+        process.wait.return_value = 0
+
+        with patch("builtins.print") as mock_print:
+            twopass._run_ffmpeg(mock_output)
+
+        mock_print.assert_any_call("\r50%", end="", flush=True)
+        process.kill.assert_not_called()
+
+    def test_run_ffmpeg_progress_batch(self):
+        twopass = TwoPass(
+            self.filename, self.target_filesize, times={"from": "00:00:00", "to": "00:01:40"}, audio_br=96
+        )
+        twopass._batch_index = 2
+
+        mock_output = MagicMock()
+        process = mock_output.global_args.return_value.run_async.return_value
+        process.stderr = iter([b"out_time_us=5000000\n", b"out_time_us=25000000\n", b"out_time_us=26000000\n"])
+        process.wait.return_value = 0
+
+        with patch("builtins.print") as mock_print:
+            twopass._run_ffmpeg(mock_output)
+
+        # whole lines with the job's number, at most one for every 10%
+        self.assertEqual(mock_print.call_args_list, [call("[job 2] 25%")])
+
+    def test_run_ffmpeg_timeout(self):
+        twopass = TwoPass(
+            self.filename,
+            self.target_filesize,
+            times={"from": "00:00:00", "to": "00:01:40"},
+            audio_br=96,
+            timeout=0.05,
+        )
+
+        # a stalled ffmpeg: stderr writes nothing and only closes once the process is killed
+        killed = threading.Event()
+
+        def stalled_stderr():
+            killed.wait(5)
+            yield from ()
+
+        mock_output = MagicMock()
+        process = mock_output.global_args.return_value.run_async.return_value
+        process.stderr = stalled_stderr()
+        process.kill.side_effect = killed.set
+        process.wait.return_value = -9
+
+        with patch("builtins.print"), self.assertRaises(TimeoutError):
+            twopass._run_ffmpeg(mock_output)
+
+        self.assertTrue(killed.is_set())
+        process.kill.assert_called_once()
+
+    @patch("ffmpeg4discord.twopass.ffmpeg.probe")
+    def test_prefetch_probes(self, mock_probe: MagicMock):
+        mock_probe.return_value = {"streams": [], "format": {"duration": "3600"}}
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            video_files = [Path(tmp_dir) / f"clip_{i}.mp4" for i in range(3)]
+            for video_file in video_files:
+                video_file.write_bytes(video_file.name.encode())
+
+            with patch("ffmpeg4discord.twopass.PROBE_CACHE_DIR", Path(tmp_dir) / "probes"):
+                prefetch_probes(video_files, workers=2)
+                _probe(video_files[0])
+
+        # every file was probed once, and later lookups hit the cache
+        self.assertEqual(mock_probe.call_count, 3)
+
+    @patch("ffmpeg4discord.twopass.os.cpu_count")
+    @patch("ffmpeg4discord.twopass.ffmpeg.probe")
+    def test_generate_params_vp9(self, mock_probe: MagicMock, mock_cpu_count: MagicMock):
+        # Set up mock values for the probe
+        mock_probe.return_value = {
+            "streams": [
+                {"index": 0, "codec_type": "video", "width": 1280, "height": 720, "r_frame_rate": "60/1"},
+                {"index": 1, "codec_type": "audio", "bit_rate": "128000"},
+            ],
+            "format": {"duration": "120"},
+        }
+        mock_cpu_count.return_value = 16
+
+        # Create TwoPass instance
+        twopass = TwoPass(self.filename, self.target_filesize, codec="libvpx-vp9", vp9_opts={"threads": 8})
+        twopass.create_bitrate_dict()
+        params = twopass.generate_params(codec="libvpx-vp9")
+
+        # Check the multi-threading options in both passes
+        for pass_params in (params["pass1"], params["pass2"]):
+            self.assertEqual(pass_params["row-mt"], 1)
+            self.assertEqual(pass_params["tile-columns"], 4)
+            self.assertEqual(pass_params["threads"], 8)
+
+        # the first pass keeps the target bitrate but not the VBV limits
+        self.assertEqual(params["pass1"]["b:v"], params["pass2"]["b:v"])
+        self.assertNotIn("maxrate", params["pass1"])
+
+    @patch("ffmpeg4discord.twopass.os.cpu_count")
+    @patch("ffmpeg4discord.twopass.ffmpeg.probe")
+    def test_run_batch(self, mock_probe: MagicMock, mock_cpu_count: MagicMock):
+        # Set up mock values for the probe
+        mock_probe.return_value = {
+            "streams": [
+                {"index": 0, "codec_type": "video", "width": 1280, "height": 720, "r_frame_rate": "60/1"},
+                {"index": 1, "codec_type": "audio", "bit_rate": "128000"},
+            ],
+            "format": {"duration": "120"},
+        }
+        mock_cpu_count.return_value = 8
+
+        # Create TwoPass instances with mocked runs
+        jobs = [TwoPass(self.filename, self.target_filesize) for _ in range(3)]
+        for size, job in enumerate(jobs):
+            job.run = MagicMock(return_value=float(size))
+
+        # Call run_batch
+        result = TwoPass.run_batch(jobs, workers=2)
+
+        # Check the results and the per-job thread limit
+        self.assertEqual(result, [0.0, 1.0, 2.0])
+        for job in jobs:
+            job.run.assert_called_once()
+            self.assertEqual(job.threads, 4)
+
+        # jobs on the same source that finish in the same second still get their own output files
+        with patch("ffmpeg4discord.twopass.time.strftime", return_value="_20240101120000"):
+            output_files = [job._build_output_path() for job in jobs]
+        self.assertEqual(len(set(output_files)), 3)
+        self.assertTrue(output_files[1].endswith("small_000100_20240101120000_2.mp4"))
+
+        # the thread limit reaches ffmpeg for the default libx264 codec
+        jobs[0].create_bitrate_dict()
+        params = jobs[0].generate_params(codec="libx264")
+        self.assertEqual(params["pass1"]["threads"], 4)
+        self.assertEqual(params["pass2"]["threads"], 4)
+
+        # a batch smaller than the worker count gets more threads per job
+        jobs = [TwoPass(self.filename, self.target_filesize) for _ in range(2)]
+        for job in jobs:
+            job.run = MagicMock(return_value=1.0)
+
+        TwoPass.run_batch(jobs)
+
+        for job in jobs:
+            self.assertEqual(job.threads, 4)
+
+        # two jobs can't write the same output file
+        jobs = [TwoPass(self.filename, size, output="clip.mp4") for size in (8, 25)]
+        with self.assertRaises(ValueError):
+            TwoPass.run_batch(jobs)
+
     @patch("ffmpeg4discord.twopass.os.path.getsize")
     @patch("ffmpeg4discord.twopass.ffmpeg.probe")
     @patch("ffmpeg4discord.twopass.ffmpeg.output")
@@ -95,6 +549,7 @@ class TestTwoPass(unittest.TestCase):
         mock_run.run.return_value = ("a", "b")
         mock_output.return_value = mock_run
         mock_output.return_value.global_args.return_value = mock_run
+        mock_run.run_async.return_value.wait.return_value = 0
 
         # Fake a file size
         mock_os_path_getsize.return_value = 52428799
@@ -106,6 +561,284 @@ class TestTwoPass(unittest.TestCase):
         self.assertLess(twopass.output_filesize, 50)  # Mocking output file size
         self.assertLess(result, 50)
 
+    @patch("ffmpeg4discord.twopass.os.path.getsize")
+    @patch("ffmpeg4discord.twopass.ffmpeg.probe")
+    @patch("ffmpeg4discord.twopass.ffmpeg.output")
+    def test_run_reuses_first_pass(
+        self, mock_output: MagicMock, mock_probe: MagicMock, mock_os_path_getsize: MagicMock
+    ):
+        # Set up mock values for the probe
+        mock_probe.return_value = {
+            "streams": [
+                {"index": 0, "codec_type": "video", "width": 1280, "height": 720, "r_frame_rate": "60/1"},
+                {"index": 1, "codec_type": "audio", "bit_rate": "128000"},
+            ],
+            "format": {"duration": "120"},
+        }
+        mock_output.return_value.global_args.return_value.run_async.return_value.wait.return_value = 0
+        mock_os_path_getsize.return_value = 10485760
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # a source of its own, so no other test's jobs share these stats
+            video_file = Path(tmp_dir) / "000100.mp4"
+            video_file.write_bytes(b"not really a video")
+
+            # Create TwoPass instance and run both passes
+            twopass = TwoPass(video_file, self.target_filesize, resolution="640x360", probe=mock_probe.return_value)
+            twopass.run()
+            self.assertEqual(mock_output.call_count, 2)
+
+            # pretend pass 1 wrote its stats, then run the same job again
+            stats_file = Path(f"{twopass.passlogfile}-0.log")
+            stats_file.touch()
+            mock_output.reset_mock()
+            twopass.run()
+
+            # only the second pass ran
+            mock_output.assert_called_once()
+            self.assertEqual(mock_output.call_args.kwargs["pass"], 2)
+
+            # a new target file size keeps the pass 1 stats, different filters don't
+            passlogfile = twopass.passlogfile
+            twopass.target_filesize = 8
+            twopass.create_bitrate_dict()
+            twopass.generate_params(codec="libx264")
+            self.assertEqual(twopass.passlogfile, passlogfile)
+
+            # another job with the same first pass shares the stats, so they stay while it may still need them
+            other = TwoPass(video_file, self.target_filesize, resolution="640x360", probe=mock_probe.return_value)
+            other.create_bitrate_dict()
+            other.generate_params(codec="libx264")
+            self.assertEqual(other.passlogfile, passlogfile)
+
+            twopass.resolution = "1280x720"
+            twopass.generate_params(codec="libx264")
+            self.assertNotEqual(twopass.passlogfile, passlogfile)
+            self.assertTrue(stats_file.exists())
+
+            # the old stats are deleted once their last user moves on to a new key
+            other.resolution = "1280x720"
+            other.generate_params(codec="libx264")
+            self.assertFalse(stats_file.exists())
+
+    @patch("ffmpeg4discord.twopass.os.path.getsize")
+    @patch("ffmpeg4discord.twopass.ffmpeg.output")
+    def test_run_short_clip(self, mock_output: MagicMock, mock_os_path_getsize: MagicMock):
+        probe = {
+            "streams": [
+                {"index": 0, "codec_type": "video", "width": 1920, "height": 1080, "r_frame_rate": "60/1"},
+                {"index": 1, "codec_type": "audio", "bit_rate": "128000"},
+            ],
+            "format": {"duration": "600", "bit_rate": "50000000"},
+        }
+
+        # Create a TwoPass instance for a 10 second clip of a high bitrate source
+        twopass = TwoPass(self.filename, 8, times={"from": "00:01:00", "to": "00:01:10"}, audio_br=96, probe=probe)
+        mock_output.return_value.global_args.return_value.run_async.return_value.wait.return_value = 0
+        mock_os_path_getsize.return_value = 7340032
+
+        twopass.run()
+
+        # one capped CRF pass, with the VBV buffer counted against the budget
+        mock_output.assert_called_once()
+        params = mock_output.call_args.kwargs
+        self.assertNotIn("pass", params)
+        self.assertEqual(params["maxrate"], twopass.bitrate_dict["b:v"] * 10 // 11)
+        self.assertEqual(params["bufsize"], params["maxrate"])
+
+        # 6457 kbps is about 0.05 bits per pixel of 1080p60, which is worth a few CRF steps above 23
+        self.assertEqual(params["crf"], 27)
+
+        # a smaller output leaves more bits for each pixel
+        twopass.resolution = "1280x720"
+        mock_output.reset_mock()
+        twopass.run()
+        self.assertEqual(mock_output.call_args.kwargs["crf"], 20)
+
+        # two passes when asked for
+        twopass.always_two_pass = True
+        mock_output.reset_mock()
+        twopass.run()
+        self.assertEqual(mock_output.call_count, 2)
+
+    @patch("ffmpeg4discord.twopass.os.path.getsize")
+    @patch("ffmpeg4discord.twopass.ffmpeg.probe")
+    @patch("ffmpeg4discord.twopass.ffmpeg.output")
+    def test_run_crf(self, mock_output: MagicMock, mock_probe: MagicMock, mock_os_path_getsize: MagicMock):
+        # Set up mock values for a probe with a low source bitrate
+        mock_probe.return_value = {
+            "streams": [
+                {"index": 0, "codec_type": "video", "width": 1280, "height": 720, "r_frame_rate": "60/1"},
+                {"index": 1, "codec_type": "audio", "bit_rate": "128000"},
+            ],
+            "format": {"duration": "120", "bit_rate": "2000000"},
+        }
+
+        # Create TwoPass instance
+        twopass = TwoPass(self.filename, self.target_filesize)
+
+        # Mock output.run() to return some values
+        mock_run = MagicMock()
+        mock_output.return_value = mock_run
+        mock_output.return_value.global_args.return_value = mock_run
+        mock_run.run_async.return_value.wait.return_value = 0
+
+        # Fake a file size
+        mock_os_path_getsize.return_value = 20971520
+
+        # Call run method
+        result = twopass.run()
+
+        # Check that a single capped CRF pass was used
+        mock_output.assert_called_once()
+        params = mock_output.call_args.kwargs
+        self.assertEqual(params["crf"], 18)
+        # the whole clip may fill the VBV buffer at once, so maxrate and bufsize shrink to keep it under the target
+        self.assertEqual(params["maxrate"], 3285000 * 120 // 121)
+        self.assertEqual(params["bufsize"], params["maxrate"])
+        self.assertNotIn("pass", params)
+        self.assertNotIn("b:v", params)
+        self.assertEqual(result, 20)
+
+    @patch("ffmpeg4discord.twopass.os.path.getsize")
+    @patch("ffmpeg4discord.twopass.ffmpeg.probe")
+    @patch("ffmpeg4discord.twopass.ffmpeg.output")
+    def test_run_copy_video(self, mock_output: MagicMock, mock_probe: MagicMock, mock_os_path_getsize: MagicMock):
+        # Set up mock values for a probe with a low bitrate h264 stream
+        mock_probe.return_value = {
+            "streams": [
+                {
+                    "index": 0,
+                    "codec_type": "video",
+                    "codec_name": "h264",
+                    "width": 1280,
+                    "height": 720,
+                    "r_frame_rate": "60/1",
+                    "bit_rate": "1500000",
+                },
+                {"index": 1, "codec_type": "audio", "bit_rate": "128000"},
+            ],
+            "format": {"duration": "120", "bit_rate": "1628000"},
+        }
+
+        # Create TwoPass instance
+        twopass = TwoPass(self.filename, self.target_filesize)
+
+        # Mock output.run() to return some values
+        mock_run = MagicMock()
+        mock_output.return_value = mock_run
+        mock_output.return_value.global_args.return_value = mock_run
+        mock_run.run_async.return_value.wait.return_value = 0
+
+        # Fake a file size
+        mock_os_path_getsize.return_value = 20971520
+
+        # Call run method
+        twopass.run()
+
+        # Check that the video stream was copied in a single run
+        mock_output.assert_called_once()
+        params = mock_output.call_args.kwargs
+        self.assertEqual(params["c:v"], "copy")
+        self.assertEqual(params["c:a"], "aac")
+        self.assertNotIn("b:v", params)
+
+        # a resize means the video has to be encoded
+        mock_output.reset_mock()
+        twopass.resolution = "640x360"
+        twopass.run()
+        self.assertNotEqual(mock_output.call_args.kwargs["c:v"], "copy")
+
+        # so does a trimmed clip, which may be busier than the file's average bitrate
+        trimmed = TwoPass(self.filename, self.target_filesize, times={"from": "00:00:10", "to": "00:01:40"})
+        mock_output.reset_mock()
+        trimmed.run()
+        self.assertNotEqual(mock_output.call_args.kwargs["c:v"], "copy")
+
+        # a copy that comes out over the target is only tried once
+        twopass.resolution = ""
+        mock_os_path_getsize.return_value = 62914560
+        mock_output.reset_mock()
+        twopass.run()
+        self.assertEqual(mock_output.call_args.kwargs["c:v"], "copy")
+
+        mock_output.reset_mock()
+        twopass.run()
+        self.assertNotEqual(mock_output.call_args.kwargs["c:v"], "copy")
+
+    @patch("ffmpeg4discord.twopass._hw_encoder_works")
+    @patch("ffmpeg4discord.twopass.os.path.getsize")
+    @patch("ffmpeg4discord.twopass.ffmpeg.probe")
+    @patch("ffmpeg4discord.twopass.ffmpeg.output")
+    def test_run_nvenc(
+        self,
+        mock_output: MagicMock,
+        mock_probe: MagicMock,
+        mock_os_path_getsize: MagicMock,
+        mock_hw_encoder_works: MagicMock,
+    ):
+        # Set up mock values for the probe
+        mock_probe.return_value = {
+            "streams": [
+                {"index": 0, "codec_type": "video", "width": 1280, "height": 720, "r_frame_rate": "60/1"},
+                {"index": 1, "codec_type": "audio", "bit_rate": "128000"},
+            ],
+            "format": {"duration": "120"},
+        }
+        mock_hw_encoder_works.return_value = True
+
+        # Create TwoPass instance
+        twopass = TwoPass(self.filename, self.target_filesize, codec="h264_nvenc")
+
+        # Mock output.run() to return some values
+        mock_run = MagicMock()
+        mock_output.return_value = mock_run
+        mock_output.return_value.global_args.return_value = mock_run
+        mock_run.run_async.return_value.wait.return_value = 0
+
+        # Fake a file size
+        mock_os_path_getsize.return_value = 20971520
+
+        # Call run method
+        twopass.run()
+
+        # Check that NVENC ran once with its own multipass rate control
+        mock_output.assert_called_once()
+        params = mock_output.call_args.kwargs
+        self.assertEqual(params["c:v"], "h264_nvenc")
+        self.assertEqual(params["rc"], "vbr")
+        self.assertEqual(params["b:v"], 3285000)
+        self.assertNotIn("pass", params)
+
+        # a single hardware pass has no pass 1 stats
+        self.assertNotIn("passlogfile", params)
+        self.assertIsNone(twopass.passlogfile)
+
+        # without a working GPU the job falls back to a libx264 two-pass encode
+        mock_hw_encoder_works.return_value = False
+        mock_output.reset_mock()
+        twopass.run()
+        self.assertEqual(twopass.codec, "libx264")
+        self.assertEqual(mock_output.call_count, 2)
+
+    @patch("ffmpeg4discord.twopass.subprocess.run")
+    @patch("ffmpeg4discord.twopass._ffmpeg_encoders")
+    def test_hw_encoder_works(self, mock_encoders: MagicMock, mock_subprocess_run: MagicMock):
+        # NVENC is compiled in, but there is no NVIDIA driver to open
+        mock_encoders.return_value = " V....D h264_nvenc           NVIDIA NVENC H.264 encoder (codec h264)"
+        mock_subprocess_run.return_value = MagicMock(returncode=1, stderr="Cannot load libcuda.so.1")
+        self.assertFalse(_hw_encoder_works.__wrapped__("h264_nvenc"))
+
+        mock_subprocess_run.return_value = MagicMock(returncode=0, stderr="")
+        self.assertTrue(_hw_encoder_works.__wrapped__("h264_nvenc"))
+        self.assertIn("h264_nvenc", mock_subprocess_run.call_args.args[0])
+
+        # builds without the encoder don't need a test encode
+        mock_encoders.return_value = ""
+        mock_subprocess_run.reset_mock()
+        self.assertFalse(_hw_encoder_works.__wrapped__("h264_nvenc"))
+        mock_subprocess_run.assert_not_called()
+
 
 if __name__ == "__main__":
     unittest.main()